@@ -3,13 +3,20 @@
 # Import libraries needed for application to work
 
 import argparse
+import concurrent.futures
+import errno
+import fcntl
+import functools
 import shutil
 import gi
 import gzip
+import hashlib
 import librepo
-import hawkey
 import tempfile
 import os
+import pickle
+import platform
+import solv
 import subprocess
 import sys
 import logging
@@ -18,14 +25,27 @@ import logging
 # have the tools we need.
 try:
     gi.require_version('Modulemd', '2.0')
+    from gi.repository import GLib
     from gi.repository import Modulemd as mmd
 except ValueError:
     print("libmodulemd 2.0 is not installed..")
     sys.exit(1)
 
+# libdeflate decompresses considerably faster than zlib, but is optional
+try:
+    import deflate
+except ImportError:
+    deflate = None
+
 # We only want to load the module metadata once. It can be reused as often as required
 _idx = None
 
+# Read compressed metadata in large chunks rather than the 8 KiB default
+_GZIP_CHUNK_SIZE = 128 * 1024
+
+# Bump whenever the format of the cached repository data changes
+_CACHE_VERSION = '1'
+
 def _get_latest_streams(mymod, stream):
     """
     Routine takes modulemd object and a stream name.
@@ -39,10 +59,12 @@ def _get_latest_streams(mymod, stream):
     return latest_streams
 
 
+@functools.lru_cache(maxsize=None)
 def _get_repoinfo(directory):
     """
     A function which goes into the given directory and sets up the
-    needed data for the repository using librepo.
+    needed data for the repository using librepo. The result is cached
+    per directory.
     Returns the LRR_YUM_REPO
     """
     with tempfile.TemporaryDirectory(prefix='elsplit_librepo_') as lrodir:
@@ -56,6 +78,21 @@ def _get_repoinfo(directory):
         return r.getinfo(librepo.LRR_YUM_REPO)
 
 
+def _read_gzip(filename):
+    """
+    Decompress a whole gzip file, using libdeflate when it is available.
+    Returns the decompressed bytes.
+    """
+    if deflate:
+        with open(filename, 'rb') as raw:
+            return deflate.gzip_decompress(raw.read())
+
+    with open(filename, 'rb', buffering=_GZIP_CHUNK_SIZE) as raw, \
+            gzip.GzipFile(fileobj=raw, mode='r') as gzf:
+        chunks = iter(lambda: gzf.read(_GZIP_CHUNK_SIZE), b'')
+        return b''.join(chunks)
+
+
 def _get_modulemd(directory=None, repo_info=None):
     """
     Retrieve the module metadata from this repository.
@@ -81,13 +118,27 @@ def _get_modulemd(directory=None, repo_info=None):
 
     _idx = mmd.ModuleIndex.new()
 
-    with gzip.GzipFile(filename=repo_info['modules'], mode='r') as gzf:
-        mmdcts = gzf.read().decode('utf-8')
-        res, failures = _idx.update_from_string(mmdcts, True)
-        if len(failures) != 0:
-            raise Exception("YAML FAILURE: FAILURES: %s" % failures)
-        if not res:
-            raise Exception("YAML FAILURE: res != True")
+    # libmodulemd 2.8+ can read the compressed file itself, which avoids
+    # holding the whole decompressed document in Python.
+    try:
+        res, failures = _idx.update_from_file(repo_info['modules'], True)
+    except GLib.Error as e:
+        # Older libmodulemd only reads plain YAML files, so decompress
+        # gzip files ourselves. Any other failure is a genuine error.
+        with open(repo_info['modules'], 'rb') as modules:
+            if modules.read(2) != b'\x1f\x8b':
+                raise
+        _idx = mmd.ModuleIndex.new()
+        try:
+            mmdcts = _read_gzip(repo_info['modules']).decode('utf-8')
+            res, failures = _idx.update_from_string(mmdcts, True)
+        except Exception as fallback_error:
+            raise fallback_error from e
+
+    if len(failures) != 0:
+        raise Exception("YAML FAILURE: FAILURES: %s" % failures)
+    if not res:
+        raise Exception("YAML FAILURE: res != True")
 
     # Ensure that every stream in the index is using v2
     _idx.upgrade_streams(mmd.ModuleStreamVersionEnum.TWO)
@@ -95,124 +146,175 @@ def _get_modulemd(directory=None, repo_info=None):
     return _idx
 
 
-def _get_hawkey_sack(repo_info):
+def _get_solv_pool(repo_info):
     """
-    A function to pull in the repository sack from hawkey.
-    Returns the sack.
+    A function to load the repository's primary metadata directly into
+    a libsolv pool.
+    Returns the pool.
     """
-    hk_repo = hawkey.Repo("")
-    hk_repo.filelists_fn = repo_info["filelists"]
-    hk_repo.primary_fn = repo_info["primary"]
-    hk_repo.repomd_fn = repo_info["repomd"]
+    pool = solv.Pool()
+    solv_repo = pool.add_repo("")
 
-    primary_sack = hawkey.Sack()
-    primary_sack.load_repo(hk_repo, build_cache=False)
+    # Only package locations are needed, which come from primary.xml;
+    # filelists.xml is much larger and is deliberately not loaded.
+    # xfopen transparently handles the compressed metadata.
+    primary = solv.xfopen(repo_info["primary"])
+    if primary is None:
+        raise Exception("Could not open %s" % repo_info["primary"])
+    try:
+        if not solv_repo.add_rpmmd(primary, None, 0):
+            raise Exception("Could not load %s: %s" % (
+                repo_info["primary"], pool.errstr))
+    finally:
+        primary.close()
 
-    return primary_sack
+    return pool
 
 
-def _get_filelist(package_sack):
+def _get_filelist(pool):
     """
-    Determine the file locations of all packages in the sack. Use the
-    package-name-epoch-version-release-arch as the key.
+    Determine the file locations of all packages in the pool. Use the
+    package-name-epoch:version-release.arch as the key.
     Returns a dictionary.
     """
     pkg_list = {}
-    for pkg in hawkey.Query(package_sack):
-        nevr = "%s-%s:%s-%s.%s" % (pkg.name, pkg.epoch,
-                                   pkg.version, pkg.release, pkg.arch)
-        pkg_list[nevr] = pkg.location
+    for pkg in pool.solvables:
+        # libsolv omits a zero epoch from the EVR, module metadata does not
+        evr = pkg.evr if ':' in pkg.evr else '0:' + pkg.evr
+        pkg_list[f"{pkg.name}-{evr}.{pkg.arch}"] = pkg.lookup_location()[0]
     return pkg_list
 
 
-def _parse_repository_non_modular(package_sack, repo_info, modpkgset):
+def _parse_repository_non_modular(pool, repo_info, modpkgset):
     """
     Simple routine to go through a repo, and figure out which packages
     are not in any module. Add the file locations for those packages
     so we can link to them.
     Returns a set of file locations.
     """
-    sack = package_sack
-    pkgs = set()
-
-    for pkg in hawkey.Query(sack):
-        if pkg.location in modpkgset:
-            continue
-        pkgs.add(pkg.location)
-    return pkgs
+    all_locations = {pkg.lookup_location()[0]
+                     for pkg in pool.solvables}
+    return all_locations - modpkgset
 
 
-def _parse_repository_modular(repo_info, package_sack):
+def _parse_repository_modular(repo_info, pool):
     """
     Returns a dictionary of packages indexed by the modules they are
-    contained in.
+    contained in, and the set of all packages contained in any module.
     """
     cts = {}
+    modpkgset = set()
     idx = _get_modulemd(repo_info=repo_info)
 
-    pkgs_list = _get_filelist(package_sack)
+    pkgs_list = _get_filelist(pool)
     idx.upgrade_streams(2)
     for modname in idx.get_module_names():
         mod = idx.get_module(modname)
         for stream in mod.get_all_streams():
             templ = list()
             for pkg in stream.get_rpm_artifacts():
-                if pkg in pkgs_list:
-                    templ.append(pkgs_list[pkg])
-                else:
-                    continue
+                location = pkgs_list.get(pkg)
+                if location is not None:
+                    templ.append(location)
+                    modpkgset.add(location)
             cts[stream.get_NSVCA()] = templ
 
-    return cts
+    return cts, modpkgset
 
 
-def _get_modular_pkgset(mod):
+def _get_ficlone():
     """
-    Takes a module and goes through the moduleset to determine which
-    packages are inside it.
-    Returns a list of packages
+    Compute the FICLONE ioctl number from linux/fs.h, _IOW(0x94, 9, int),
+    which shares the data extents of one file with another on
+    copy-on-write filesystems. A few architectures encode the direction
+    bits of ioctl numbers differently from the generic layout.
+    Returns the request number for the running architecture.
     """
-    pkgs = set()
+    request = (0x94 << 8) | 9 | (4 << 16)
+    if platform.machine().startswith(('ppc', 'powerpc', 'mips',
+                                      'sparc', 'alpha')):
+        return request | (4 << 29)
+    return request | (1 << 30)
 
-    for modcts in mod.values():
-        for pkg in modcts:
-            pkgs.add(pkg)
 
-    return list(pkgs)
+_FICLONE = _get_ficlone()
 
 
-def _perform_action(src, dst, action):
+def _reflink(src, dst):
     """
-    Performs either a copy, hardlink or symlink of the file src to the
-    file destination.
+    Create dst as a reflink (copy-on-write clone) of src. Falls back to
+    a regular copy if the filesystem does not support reflinks.
     Returns None
     """
-    if action == 'copy':
+    sfd = os.open(src, os.O_RDONLY)
+    try:
+        dfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                      os.fstat(sfd).st_mode & 0o777)
         try:
-            shutil.copy(src, dst)
-        except FileNotFoundError:
-            # Missing files are acceptable: they're already checked before
-            # this by validate_filenames.
-            pass
-    elif action == 'hardlink':
-        os.link(src, dst)
-    elif action == 'symlink':
-        os.symlink(src, dst)
+            fcntl.ioctl(dfd, _FICLONE, sfd)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV,
+                               errno.EINVAL, errno.ENOTTY):
+                # Do not leave the empty target file behind
+                os.unlink(dst)
+                raise
+        finally:
+            os.close(dfd)
+    finally:
+        os.close(sfd)
 
+    shutil.copy(src, dst)
 
-def validate_filenames(directory, repoinfo):
+
+# Map the --action choices onto the functions that implement them
+_ACTIONS = {
+    'hardlink': os.link,
+    'symlink': os.symlink,
+    'reflink': _reflink,
+    'copy': shutil.copy,
+}
+
+
+def _list_files(directory):
+    """
+    Collect the names of the files in a directory.
+    Returns a set of file names, or None if the directory cannot be read.
+    """
+    try:
+        with os.scandir(directory) as it:
+            return {entry.name for entry in it if entry.is_file()}
+    except OSError:
+        return None
+
+
+def validate_filenames(directory, repoinfo, fail_fast=False):
     """
     Take a directory and repository information. Test each file in
     repository to exist in said module. This stops us when dealing
-    with broken repositories or missing modules.
+    with broken repositories or missing modules. With fail_fast, stop
+    at the first missing file instead of reporting all of them.
     Returns True if no problems found. False otherwise.
     """
     isok = True
+    # Read each package directory once instead of stat'ing every file
+    present = {}
     for modname in repoinfo:
         for pkg in repoinfo[modname]:
-            if not os.path.exists(os.path.join(directory, pkg)):
+            pkgdir, _, pkgfile = pkg.rpartition('/')
+            if pkgdir not in present:
+                present[pkgdir] = _list_files(os.path.join(directory, pkgdir))
+            if present[pkgdir] is None:
+                # The directory could not be listed (e.g. it is missing or
+                # only searchable), so check the file itself.
+                found = os.path.exists(os.path.join(directory, pkg))
+            else:
+                found = pkgfile in present[pkgdir]
+            if not found:
                 isok = False
                 print("Path %s from mod %s did not exist" % (pkg, modname))
+                if fail_fast:
+                    return isok
     return isok
 
 
@@ -331,8 +433,9 @@ def _pad_svca(svca, target_length):
     return svca
 
 
-def _dump_modulemd(modname, yaml_file):
-    idx = _get_modulemd()
+def _dump_modulemd(modname, yaml_file, directory):
+    # The index may not be loaded yet if the repository came from cache
+    idx = _get_modulemd(directory)
     assert idx
 
     # Create a new index to hold the information about this particular
@@ -380,48 +483,150 @@ def _dump_modulemd(modname, yaml_file):
         raise
 
 
+def _run_action(action_fn, src, dst, skip_missing):
+    """
+    Apply action_fn to a single src/dst pair.
+    Returns None
+    """
+    try:
+        action_fn(src, dst)
+    except FileNotFoundError:
+        # Missing files are acceptable with --skip-missing; otherwise
+        # they have already been checked by validate_filenames.
+        if not skip_missing:
+            raise
+
+
 def perform_split(repos, args, def_modules):
-    for modname in repos:
-        if args.only_defaults and modname not in def_modules:
-            continue
+    """
+    Populate one target directory per module with its packages, using
+    the file operation selected by --action.
+    Returns None
+    """
+    # Resolve the action once rather than branching on it for every file
+    action_fn = _ACTIONS[args.action]
+    # Package locations are always relative "dir/file.rpm" paths, so
+    # plain string operations are enough to build the file paths.
+    repo_prefix = args.repository + os.sep
 
-        targetdir = os.path.join(args.target, modname)
-        os.mkdir(targetdir)
+    modnames = [modname for modname in repos
+                if not args.only_defaults or modname in def_modules]
 
-        for pkg in repos[modname]:
-            _, pkgfile = os.path.split(pkg)
-            _perform_action(
-                os.path.join(args.repository, pkg),
-                os.path.join(targetdir, pkgfile),
-                args.action)
+    # Create all of the target directories up front, so that the file
+    # operations below are not interleaved with directory creation.
+    for modname in modnames:
+        os.makedirs(os.path.join(args.target, modname), exist_ok=True)
+
+    # Collect every file operation first, so the operations themselves
+    # can run concurrently.
+    pairs = []
+    for modname in modnames:
+        targetdir = os.path.join(args.target, modname)
+        targetdir_sep = targetdir + os.sep
+
+        # Sorting by path walks each source directory in order
+        seen = {}
+        for pkg in sorted(repos[modname]):
+            pkgfile = pkg.rpartition('/')[2]
+            # The same file may be listed more than once for a module,
+            # but two different files cannot share a name in the target.
+            if pkgfile in seen:
+                if seen[pkgfile] == pkg:
+                    continue
+                raise ValueError(
+                    "Paths %s and %s from mod %s have the same file name" %
+                    (seen[pkgfile], pkg, modname))
+            seen[pkgfile] = pkg
+            pairs.append((repo_prefix + pkg, targetdir_sep + pkgfile))
 
         # Extract the modular metadata for this module
         if modname != 'non_modular':
-            _dump_modulemd(modname, os.path.join(targetdir, 'modules.yaml'))
+            _dump_modulemd(modname, os.path.join(targetdir, 'modules.yaml'),
+                           args.repository)
+
+    # The operations are independent and syscall-bound, so overlap them
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        futures = [executor.submit(_run_action, action_fn, src, dst,
+                                   args.skip_missing)
+                   for src, dst in pairs]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                # Re-raises any error from the worker thread
+                future.result()
+        except BaseException:
+            # Stop at the first error instead of filling in the rest of
+            # the target tree
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def _run_quiet(cmd):
+    """
+    Run an external tool, discarding its output but keeping its errors.
+    Returns None on success, or a description of the failure.
+    """
+    proc = subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, check=False)
+    if proc.returncode == 0:
+        return None
+    return "%s exited with %d: %s" % (
+        cmd[0], proc.returncode,
+        proc.stderr.decode('utf-8', 'replace').strip())
+
+
+def _create_repo(targetdir, modname):
+    """
+    Generate the repository metadata for a single split repository,
+    adding the module metadata for modular ones.
+    Returns None on success, or a description of the failure.
+    """
+    # Each createrepo_c gets a couple of workers, as several run at once
+    error = _run_quiet([
+        'createrepo_c', targetdir,
+        '--no-database',
+        '--workers=2'])
+    if error or modname == 'non_modular':
+        return error
+
+    return _run_quiet([
+        'modifyrepo_c',
+        '--mdtype=modules',
+        os.path.join(targetdir, 'modules.yaml'),
+        os.path.join(targetdir, 'repodata')
+    ])
 
 
 def create_repos(target, repos, def_modules, only_defaults):
     """
     Routine to create repositories. Input is target directory and a
-    list of repositories.
+    list of repositories. Failures are reported together once every
+    repository has been attempted.
     Returns None
     """
-    for modname in repos:
-        if only_defaults and modname not in def_modules:
-            continue
+    max_workers = min(os.cpu_count() or 1, 8)
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        futures = {}
+        for modname in repos:
+            if only_defaults and modname not in def_modules:
+                continue
 
-        targetdir = os.path.join(target, modname)
+            future = executor.submit(
+                _create_repo, os.path.join(target, modname), modname)
+            futures[future] = modname
 
-        subprocess.run([
-            'createrepo_c', targetdir,
-            '--no-database'])
-        if modname != 'non_modular':
-            subprocess.run([
-                'modifyrepo_c',
-                '--mdtype=modules',
-                os.path.join(targetdir, 'modules.yaml'),
-                os.path.join(targetdir, 'repodata')
-            ])
+        failed = []
+        for future in concurrent.futures.as_completed(futures):
+            error = future.result()
+            if error:
+                failed.append(futures[future])
+                logging.error("Could not create repository for {}: {}".format(
+                    futures[future], error))
+
+    if failed:
+        raise Exception("Repository creation failed for: %s" %
+                        ", ".join(sorted(failed)))
 
 
 def parse_args():
@@ -434,11 +639,15 @@ def parse_args():
     parser.add_argument('--debug', help='Enable debug logging',
                         action='store_true', default=False)
     parser.add_argument('--action', help='Method to create split repos files',
-                        choices=('hardlink', 'symlink', 'copy'),
+                        choices=('hardlink', 'symlink', 'reflink', 'copy'),
                         default='hardlink')
     parser.add_argument('--target', help='Target directory for split repos')
     parser.add_argument('--skip-missing', help='Skip missing packages',
                         action='store_true', default=False)
+    parser.add_argument('--cache',
+                        help='Cache parsed repository metadata between '
+                             'runs',
+                        action='store_true', default=False)
     parser.add_argument('--create-repos', help='Create repository metadatas',
                         action='store_true', default=False)
     parser.add_argument('--only-defaults', help='Only output default modules',
@@ -467,37 +676,124 @@ def setup_target(args):
             os.mkdir(args.target)
 
 
-def parse_repository(directory):
+def _get_cache_path(directory):
+    """
+    Work out where the parsed form of a repository is cached. There is a
+    single cache file per repository directory, which is overwritten
+    whenever the repository changes.
+    Returns the path of the cache file.
+    """
+    name = hashlib.sha256(directory.encode('utf-8')).hexdigest()
+    cache_home = os.environ.get('XDG_CACHE_HOME',
+                                os.path.expanduser('~/.cache'))
+    return os.path.join(cache_home, 'grobisplitter', name + '.pkl')
+
+
+def _get_fingerprint(repo_info):
+    """
+    Summarise repomd.xml and the metadata files that get parsed, so that
+    any change to the repository invalidates the cached data.
+    Returns a hex digest.
+    """
+    key = hashlib.sha256()
+    key.update(_CACHE_VERSION.encode('utf-8'))
+    with open(repo_info['repomd'], 'rb') as repomd:
+        key.update(repomd.read())
+    for mdtype in ('primary', 'modules'):
+        if mdtype in repo_info:
+            st = os.stat(repo_info[mdtype])
+            key.update(("%s:%d:%d" % (mdtype, st.st_mtime_ns,
+                                      st.st_size)).encode('utf-8'))
+    return key.hexdigest()
+
+
+def _load_cache(cache_path, fingerprint):
+    """
+    Load a previously parsed repository from the cache.
+    Returns the cached dict, or None if there is no up to date entry.
+    """
+    try:
+        with open(cache_path, 'rb') as cache:
+            cached_fingerprint, mod = pickle.load(cache)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.debug("Ignoring unreadable cache {}: {}".format(
+            cache_path, e))
+        return None
+
+    if cached_fingerprint != fingerprint:
+        logging.debug("Cache {} is out of date".format(cache_path))
+        return None
+    return mod
+
+
+def _save_cache(cache_path, fingerprint, mod):
+    """
+    Atomically write a parsed repository to the cache. Failing to write
+    the cache is not fatal.
+    Returns None
+    """
+    tmpname = None
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(cache_path), delete=False) as cache:
+            tmpname = cache.name
+            pickle.dump((fingerprint, mod), cache, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, cache_path)
+    except (OSError, pickle.PicklingError) as e:
+        logging.debug("Could not write cache {}: {}".format(cache_path, e))
+        if tmpname:
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+
+
+def parse_repository(directory, use_cache=False):
     """
     Parse a specific directory, returning a dict with keys module NSVC's and
     values a list of package NVRs.
     The dict will also have a key "non_modular" for the non-modular packages.
+    With use_cache, the result is cached on disk and reused while the
+    repository metadata is unchanged.
     """
     directory = os.path.abspath(directory)
     repo_info = _get_repoinfo(directory)
 
-    # Get the package sack and get a filelist of all packages.
-    package_sack = _get_hawkey_sack(repo_info)
-    _get_filelist(package_sack)
+    if use_cache:
+        cache_path = _get_cache_path(directory)
+        fingerprint = _get_fingerprint(repo_info)
+        mod = _load_cache(cache_path, fingerprint)
+        if mod is not None:
+            logging.debug("Using cached repository data {}".format(
+                cache_path))
+            return mod
+
+    # Load the package metadata of the repository.
+    pool = _get_solv_pool(repo_info)
 
     # If we have a repository with no modules we do not want our
     # script to error out but just remake the repository with
     # everything in a known sack (aka non_modular).
 
     if 'modules' in repo_info:
-        mod = _parse_repository_modular(repo_info, package_sack)
-        modpkgset = _get_modular_pkgset(mod)
+        mod, modpkgset = _parse_repository_modular(repo_info, pool)
     else:
         mod = dict()
         modpkgset = set()
 
-    non_modular = _parse_repository_non_modular(package_sack, repo_info,
+    non_modular = _parse_repository_non_modular(pool, repo_info,
                                                 modpkgset)
     mod['non_modular'] = non_modular
 
     # We should probably go through our default modules here and
     # remove them from our mod. This would cut down some code paths.
 
+    if use_cache:
+        _save_cache(cache_path, fingerprint, mod)
+
     return mod
 
 
@@ -511,7 +807,7 @@ def main():
     # Go through arguments and act on their values.
     setup_target(args)
 
-    repos = parse_repository(args.repository)
+    repos = parse_repository(args.repository, args.cache)
 
     if args.only_defaults:
         def_modules = get_default_modules(args.repository, args.ignore_missing_default_deps)
@@ -521,7 +817,7 @@ def main():
     def_modules.add('non_modular')
 
     if not args.skip_missing:
-        if not validate_filenames(args.repository, repos):
+        if not validate_filenames(args.repository, repos, fail_fast=True):
             raise ValueError("Package files were missing!")
     if args.target:
         perform_split(repos, args, def_modules)